@@ -15,23 +15,27 @@ class LinkSeg(nn.Module):
                 dropout_gnn=.1,
                 dropout_cnn=.2,
                 dropout_egat=.5,
-                max_len=1500):
+                max_len=1500,
+                gnn_topk=0,
+                egat_pool_heads=False,
+                bf16=False):
         super(LinkSeg, self).__init__()
 
         # frame encoder
         self.encoder = encoder
-        # feature smoothing
+        # feature smoothing (dense graph, or k-nearest-neighbour graph if gnn_topk > 0)
+        self.gnn_topk = gnn_topk
         self.gnn = GCN_DENSE(in_size=hidden_size, hid_size=hidden_size, dropout=dropout_gnn)
         self.mlp = nn.Linear(hidden_size, hidden_size)
         # link feature extractor
-        self.conv = ConvNetSSM(input_channels=1, output_channels=output_channels, shape=5, dropout=dropout_cnn)
+        self.conv = ConvNetSSM(input_channels=1, output_channels=output_channels, shape=5, dropout=dropout_cnn, bf16=bf16)
         # positional embedding & linear projection
         self.pos_embedding = nn.Parameter(torch.normal(mean=0, std=0.02, size=(max_len, output_channels)))
         self.fc = nn.Sequential(nn.Linear(output_channels, output_channels))
         # link classifier
         self.final_projection = nn.Linear(output_channels, nb_ssm_classes)
         # graph attention net
-        self.gnn_final = EGAT(in_size=hidden_size, feat_size=output_channels, heads=8, feat_dropout=dropout_egat, attn_dropout=dropout_egat)
+        self.gnn_final = EGAT(in_size=hidden_size, feat_size=output_channels, heads=8, feat_dropout=dropout_egat, attn_dropout=dropout_egat, pool_heads=egat_pool_heads)
         # prediction heads
         self.bound_predictor = nn.Linear(hidden_size*2+output_channels, 1)
         self.class_predictor = nn.Linear(hidden_size, nb_section_labels)
@@ -44,23 +48,26 @@ class LinkSeg(nn.Module):
         # self-similarity calculation (A)
         N = x_encoded.size(0)
         a = F.normalize(x_encoded, p=2, dim=-1)
-        dist = torch.cdist(a, a, p=2).pow(2)
+        dist = squared_distances(a)
         std = torch.std(dist)
         gamma = -1/(2*std)
         A = dist.mul(gamma).exp()
+        if self.gnn_topk:
+            A = topk_graph(A, self.gnn_topk)
         
         # feature smoothing (X')
         x_encoded = self.mlp(self.gnn(A, x_encoded))
 
         # self-similarity calculation (A')
         a = F.normalize(x_encoded, p=2, dim=-1)
-        A = torch.cdist(a, a, p=2).pow(2)
+        A = squared_distances(a)
         A_conv = self.conv(A.unsqueeze(0)).squeeze(0)
         A_conv = A_conv.permute(1, 2, 0)
         
         # positional embedding (E')
-        A = torch.ones((N, N), device=x.device)
-        src, dst = torch.nonzero(A, as_tuple=True)
+        # all (i, j) pairs in row-major order, without materializing a dense mask
+        nodes = torch.arange(N, device=x.device)
+        src, dst = nodes.repeat_interleave(N), nodes.repeat(N)
         diff = torch.abs(src-dst) 
         x_time = self.pos_embedding[diff]
         x_pairwise = x_time.reshape(N, N, -1)
@@ -70,7 +77,8 @@ class LinkSeg(nn.Module):
         A_pred = self.final_projection(A_conv).squeeze()
 
         # graph attention network
-        edge_feat = A_conv[src, dst]
+        # complete graph, edges are enumerated row-major: gathering A_conv[src, dst] is a plain view
+        edge_feat = A_conv.reshape(N * N, -1)
         g = dgl.graph((src, dst), num_nodes=N)
         x_gnn_final = self.gnn_final(g, x_encoded, edge_feat)
 
@@ -111,6 +119,7 @@ class FrameEncoder(nn.Module):
         attention_ndim = 32*2,
         attention_nlayers = 2,
         attention_nheads = 8,
+        bf16=False,
     ):
         super(FrameEncoder, self).__init__()
 
@@ -122,7 +131,7 @@ class FrameEncoder(nn.Module):
                                                                      hop_length=hop_length,
                                                                      power=2)
         self.amplitude_to_db = torchaudio.transforms.AmplitudeToDB()
-        self.frontend = ResFrontEnd(conv_ndim=conv_ndim, nharmonics=1, nmels=n_mels, output_size=attention_ndim, dropout=dropout)
+        self.frontend = ResFrontEnd(conv_ndim=conv_ndim, nharmonics=1, nmels=n_mels, output_size=attention_ndim, dropout=dropout, bf16=bf16)
         self.dropout = nn.Dropout(dropout)
         
         # Positional embedding
@@ -136,6 +145,7 @@ class FrameEncoder(nn.Module):
             attention_ndim // 2, #,
             attention_ndim,
             dropout,
+            bf16=bf16,
         )
 
         # projection
@@ -3,11 +3,20 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from EMA import EMA
-from einops import rearrange
 import dgl
 
 
+@torch.jit.script
+def fused_add_elu(x, out):
+    """
+    Residual add followed by ELU, scripted so that the fuser can emit a single elementwise kernel 
+    (on CUDA; measured neutral on CPU).
+    """
+    return F.elu(x + out)
+
+
 class Res2DMaxPoolModule(nn.Module):
     """
     Residual block, adapted from https://github.com/minzwon/semi-supervised-music-tagging-transformer.
@@ -34,9 +43,17 @@ class Res2DMaxPoolModule(nn.Module):
         out = self.bn_2(self.conv_2(self.relu(self.bn_1(self.conv_1(x)))))
         if self.diff:
             x = self.bn_3(self.conv_3(x))
-        out = x + out
-        out = self.mp(self.relu(out))
+        out = self.mp(fused_add_elu(x, out))
         return out
+
+    def fuse_for_inference(self):
+        """
+        Folds the BatchNorm2d running statistics into the preceding convolutions (eval mode only).
+        """
+        self.conv_1, self.bn_1 = fuse_conv_bn(self.conv_1, self.bn_1)
+        self.conv_2, self.bn_2 = fuse_conv_bn(self.conv_2, self.bn_2)
+        if self.diff:
+            self.conv_3, self.bn_3 = fuse_conv_bn(self.conv_3, self.bn_3)
     
 
 class ResFrontEnd(nn.Module):
@@ -45,8 +62,9 @@ class ResFrontEnd(nn.Module):
     Copyright (c) 2021 ByteDance. Code developed by Minz Won.
     """
 
-    def __init__(self, conv_ndim=64, nharmonics=1, nmels=64, output_size=32, dropout=0):
+    def __init__(self, conv_ndim=64, nharmonics=1, nmels=64, output_size=32, dropout=0, bf16=False):
         super(ResFrontEnd, self).__init__()
+        self.bf16 = bf16
         self.input_bn = nn.BatchNorm2d(nharmonics)
 
         self.layer1 = Res2DMaxPoolModule(nharmonics, conv_ndim, pooling=(2, 2))
@@ -55,23 +73,120 @@ class ResFrontEnd(nn.Module):
         self.dropout = nn.Dropout(dropout)
         fc_dim = nmels // 2 // 2  // 2 * conv_ndim
         self.fc = nn.Linear(fc_dim, output_size)
+        self.graph = None
+
+    def build_graph(self, example_shape):
+        """
+        Captures the forward pass for float32 inputs of shape example_shape into a CUDA graph, 
+        other inputs keep running eagerly. See capture_cuda_graph.
+        """
+        self.graph = capture_cuda_graph(self, example_shape, self.fc.weight.device)
         
     def forward(self, hcqt):
-        # batch normalization
-        out = self.input_bn(hcqt)
+        if self.graph is not None and not self.training and cuda_graph_accepts(self.graph, hcqt):
+            return replay_cuda_graph(self.graph, hcqt)
+        return self._forward(hcqt)
+
+    def _forward(self, hcqt):
+        with bf16_autocast(hcqt, self.bf16):
+            # batch normalization
+            out = self.input_bn(hcqt)
+
+            # CNN
+            out = self.layer1(out)
+            out = self.layer2(out)
+            out = self.layer3(out)
+            
+            # permute and channel control
+            b, c, f, t = out.shape
+            out = out.permute(0, 3, 1, 2)  # batch, time, conv_ndim, freq
+            out = out.reshape(b, t, -1)  # batch, time, fc_ndim
+            out = self.dropout(out)
+            out = self.fc(out)  # batch, time, attention_ndim
+        return out.to(hcqt.dtype)
+
+
+def bf16_autocast(x, enabled):
+    """
+    bfloat16 mixed-precision context on the device of x (no-op when disabled).
+    """
+    return torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def capture_cuda_graph(module, example_shape, device):
+    """
+    Records module._forward applied to a static float32 input of shape example_shape into a CUDA graph.
+    Returns (graph, static_input, static_output).
+    The module must be in eval mode (the warmup runs would otherwise update the BatchNorm running 
+    statistics, and the graph would replay batch statistics and dropout), and the capture must come 
+    after every weight rewrite (fuse_for_inference, .to(memory_format=...), .to(device)): the graph 
+    holds raw pointers to the parameters. Not exposed by predict.py and not verified on a GPU yet.
+    """
+    if module.training:
+        raise RuntimeError('CUDA graph capture requires an eval-mode module, call .eval() first')
+    static_input = torch.zeros(example_shape, device=device)
+    with torch.no_grad():
+        # warmup on a side stream (cuDNN autotuning, allocator) before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                module._forward(static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_output = module._forward(static_input)
+    return graph, static_input, static_output
+
+
+def cuda_graph_accepts(cuda_graph, x):
+    """
+    True if x matches the shape, dtype and device of the captured static input.
+    """
+    static_input = cuda_graph[1]
+    return x.shape == static_input.shape and x.dtype == static_input.dtype and x.device == static_input.device
+
+
+def replay_cuda_graph(cuda_graph, x):
+    graph, static_input, static_output = cuda_graph
+    static_input.copy_(x)
+    graph.replay()
+    return static_output.clone()
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Returns (fused_conv, nn.Identity()) with the statistics of bn folded into conv, 
+    or (conv, bn) unchanged if bn normalizes with batch statistics.
+    """
+    if conv.training or bn.training or not bn.track_running_stats:
+        return conv, bn
+    return fuse_conv_bn_eval(conv, bn), nn.Identity()
+
+
+def fuse_for_inference(model):
+    """
+    Applies Conv2d/BatchNorm2d fusion to every convolutional block of an eval-mode model.
+    """
+    for module in model.modules():
+        if isinstance(module, (Res2DMaxPoolModule, Conv_2d)):
+            module.fuse_for_inference()
+    return model
+
+
+def set_qkv_buffers(model, max_tokens):
+    """
+    Enables the reused qkv buffer of every Attention module for inputs of at most max_tokens 
+    (b * n) tokens, or releases the buffers when max_tokens is None. Inference only: the buffer 
+    is incompatible with autograd, autocast, quantized linears and torch.compile.
+    """
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.max_tokens = max_tokens
+            module.qkv_buffer = None
+    return model
 
-        # CNN
-        out = self.layer1(out)
-        out = self.layer2(out)
-        out = self.layer3(out)
-        
-        # permute and channel control
-        b, c, f, t = out.shape
-        out = out.permute(0, 3, 1, 2)  # batch, time, conv_ndim, freq
-        out = out.contiguous().view(b, t, -1)  # batch, time, fc_ndim
-        out = self.dropout(out)
-        out = self.fc(out)  # batch, time, attention_ndim
-        return out
 
 # Transformer modules
 """
@@ -122,32 +237,41 @@ class Attention(nn.Module):
         self.to_qkv = nn.Linear(dim, inner_dim * 3, bias=False)
         self.to_out = nn.Sequential(nn.Linear(inner_dim, dim), nn.Dropout(dropout))
 
+        # inference-time qkv buffer, disabled unless set_qkv_buffers() is called at load time
+        self.max_tokens = None
+        self.register_buffer('qkv_buffer', None, persistent=False)
+
+    def project_qkv(self, x):
+        """
+        to_qkv(x) for x of shape (b * n, dim). When enabled, projections of at most max_tokens rows 
+        are written into a reused buffer instead of a fresh allocation.
+        """
+        rows = x.size(0)
+        if self.max_tokens is None or rows > self.max_tokens:
+            return self.to_qkv(x)
+        if self.qkv_buffer is None or self.qkv_buffer.size(0) < rows:
+            self.qkv_buffer = x.new_empty(rows, self.to_qkv.out_features)
+        return torch.mm(x, self.to_qkv.weight.t(), out=self.qkv_buffer[:rows])
+
     def forward(self, x, mask=None):
         b, n, _, h = *x.shape, self.heads
-        qkv = self.to_qkv(x).chunk(3, dim=-1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), qkv)
-
-        dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
-        mask_value = -torch.finfo(dots.dtype).max
-
-        if mask is not None:
-            mask = F.pad(mask.flatten(1), (1, 0), value=True)
-            assert mask.shape[-1] == dots.shape[-1], 'mask has incorrect dimensions'
-            mask = mask[:, None, :] * mask[:, :, None]
-            dots.masked_fill_(~mask, mask_value)
-            del mask
-
-        attn = dots.softmax(dim=-1)
-
-        out = torch.einsum('bhij,bhjd->bhid', attn, v)
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        # (b * n, dim) operand as required by the torch.mm of the qkv buffer (F.linear folds 3D inputs
+        # into the same mm anyway), single contiguous (3, b, h, n, d) buffer instead of three rearranged chunks
+        qkv = self.project_qkv(x.reshape(b * n, -1)).reshape(b, n, 3, h, -1).permute(2, 0, 3, 1, 4).contiguous()
+        q, k, v = qkv.unbind(0)
+
+        # fused QK^T, scaling, masking, softmax and AV (FlashAttention / memory-efficient kernels),
+        # mask is the additive (b, 1, 1, n) key mask precomputed by the Transformer
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, scale=self.scale)
+        out = out.transpose(1, 2).reshape(b * n, -1)
         out = self.to_out(out)
-        return out
+        return out.reshape(b, n, -1)
 
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout):
+    def __init__(self, dim, depth, heads, dim_head, mlp_dim, dropout, bf16=False):
         super().__init__()
+        self.bf16 = bf16
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(
@@ -164,10 +288,17 @@ class Transformer(nn.Module):
             )
 
     def forward(self, x, mask=None):
-        for attn, ff in self.layers:
-            x = attn(x, mask=mask)
-            x = ff(x)
-        return x
+        dtype = x.dtype
+        if mask is not None:
+            # additive key mask (0 / -inf), built once and shared by all layers
+            mask = F.pad(mask.flatten(1), (1, 0), value=True)
+            assert mask.shape[-1] == x.shape[1], 'mask has incorrect dimensions'
+            mask = torch.zeros(mask.shape, dtype=dtype, device=x.device).masked_fill_(~mask, float('-inf'))[:, None, None, :]
+        with bf16_autocast(x, self.bf16):
+            for attn, ff in self.layers:
+                x = attn(x, mask=mask)
+                x = ff(x)
+        return x.to(dtype)
 
 
 class Conv_2d(nn.Module):
@@ -183,7 +314,6 @@ class Conv_2d(nn.Module):
         self.conv_1x1 = nn.Conv2d(input_channels, output_channels, 1, stride=stride, padding=padding, dilation=1, groups=groups, bias=True)
         self.bn_1x1 = nn.BatchNorm2d(output_channels, affine=affine, track_running_stats=track_running_stats)
 
-        self.relu = nn.ELU()
         self.attention = EMA(channels=output_channels, factor=4)
         self.dropout = nn.Dropout(dropout)
 
@@ -192,18 +322,25 @@ class Conv_2d(nn.Module):
         x = self.conv(x)
         x = self.attention(x)
         x = self.bn(x)
-        x = self.bn_1x1(self.conv_1x1(features)) + x
-        x = self.relu(x)
+        x = fused_add_elu(self.bn_1x1(self.conv_1x1(features)), x)
         x = self.dropout(x)
         return x
+
+    def fuse_for_inference(self):
+        """
+        Folds bn_1x1 into conv_1x1 when it tracks running statistics. self.bn is not a candidate 
+        (the attention module sits between conv and bn), and batch-statistics BNs cannot be folded.
+        """
+        self.conv_1x1, self.bn_1x1 = fuse_conv_bn(self.conv_1x1, self.bn_1x1)
     
 
 class ConvNetSSM(nn.Module):
     """
     Link feature extractor: 2D ConvNet with growing dilation rate. 
     """
-    def __init__(self, input_channels, output_channels, shape, dropout=.2):
+    def __init__(self, input_channels, output_channels, shape, dropout=.2, bf16=False):
         super(ConvNetSSM, self).__init__()
+        self.bf16 = bf16
         
         self.input_bn = nn.BatchNorm2d(input_channels, affine=False, track_running_stats=False)
     
@@ -214,26 +351,63 @@ class ConvNetSSM(nn.Module):
         self.conv5 = Conv_2d(output_channels, output_channels, shape=shape, dilation=16, dropout=dropout)
         self.conv6 = Conv_2d(output_channels, output_channels, shape=shape, dilation=32, dropout=dropout)
         self.conv7 = Conv_2d(output_channels, output_channels, shape=shape, dilation=64, dropout=dropout)
+        self.graph = None
+
+    def build_graph(self, example_shape):
+        """
+        Captures the forward pass for float32 inputs of shape example_shape into a CUDA graph, 
+        other inputs keep running eagerly. See capture_cuda_graph.
+        """
+        self.graph = capture_cuda_graph(self, example_shape, self.conv1.conv.weight.device)
 
     def forward(self, x):
+        if self.graph is not None and not self.training and cuda_graph_accepts(self.graph, x):
+            return replay_cuda_graph(self.graph, x)
+        return self._forward(x)
+
+    def _forward(self, x):
         # reshape
         if len(x.size()) == 2:
             x = x.unsqueeze(0).unsqueeze(1)
         elif len(x.size()) == 3:
             x = x.unsqueeze(0)
-        # input normalization
-        x = self.input_bn(x)
-        # CNN
-        x = self.conv1(x)
-        x = self.conv2(x)
-        x = self.conv3(x)
-        x = self.conv4(x)
-        x = self.conv5(x)
-        x = self.conv6(x)
-        x = self.conv7(x)
-        return x
+        dtype = x.dtype
+        with bf16_autocast(x, self.bf16):
+            # input normalization
+            x = self.input_bn(x)
+            # CNN
+            x = self.conv1(x)
+            x = self.conv2(x)
+            x = self.conv3(x)
+            x = self.conv4(x)
+            x = self.conv5(x)
+            x = self.conv6(x)
+            x = self.conv7(x)
+        return x.to(dtype)
     
 
+def squared_distances(a):
+    """
+    Pairwise squared euclidean distances between unit-norm rows, ||a_i - a_j||^2 = 2 - 2 <a_i, a_j>, 
+    computed as a single scaled GEMM.
+    """
+    return torch.addmm(a.new_full((1,), 2.), a, a.t(), alpha=-2).clamp_(min=0)
+
+
+def topk_graph(A, k):
+    """
+    Sparsifies a dense affinity matrix by keeping the k strongest neighbours of every node.
+    Returns a DGL graph with edges j -> i, weights normalized by the weighted in-degree 
+    as in DenseGraphConv(norm='right').
+    """
+    N = A.size(0)
+    values, src = A.topk(min(k, N), dim=1)
+    dst = torch.arange(N, device=A.device).repeat_interleave(values.size(1))
+    g = dgl.graph((src.flatten(), dst), num_nodes=N)
+    g.edata['w'] = (values / values.sum(1, keepdim=True).clamp(min=1)).reshape(-1, 1)
+    return g
+
+
 class GCN_DENSE(nn.Module):
     def __init__(self, in_size, hid_size, dropout = 0.2):
         super().__init__()
@@ -246,16 +420,26 @@ class GCN_DENSE(nn.Module):
         
 
     def forward(self, A, h):
-        h = self.relu(self.conv_1(A, h)) + h
+        # A: dense adjacency matrix, or sparse DGL graph carrying normalized edge weights 'w'
+        h = self.relu(self.graph_conv(self.conv_1, A, h)) + h
         h = self.dropout(h)
-        h = self.conv_2(A, h) + h
+        h = self.graph_conv(self.conv_2, A, h) + h
         h = self.dropout(h)
         return h
+
+    @staticmethod
+    def graph_conv(conv, A, h):
+        if isinstance(A, dgl.DGLGraph):
+            # same computation as the DenseGraphConv, as an SpMM over the edges of A only
+            return dgl.ops.u_mul_e_sum(A, torch.matmul(h, conv.weight), A.edata['w']) + conv.bias
+        return conv(A, h)
         
 
 class EGAT(nn.Module):
-    def __init__(self, in_size, feat_size, heads, feat_dropout=.1, attn_dropout=.1):
+    def __init__(self, in_size, feat_size, heads, feat_dropout=.1, attn_dropout=.1, pool_heads=False):
         super().__init__()
+        # averaging the heads of layer_1 (instead of concatenating them) shrinks layer_2's input by heads
+        self.pool_heads = pool_heads
 
         # two-layer GAT
         self.layer_1 = dgl.nn.pytorch.conv.EdgeGATConv(in_feats=in_size, 
@@ -270,7 +454,7 @@ class EGAT(nn.Module):
                                                        allow_zero_in_degree=False, 
                                                        bias=True)
         
-        self.layer_2 = dgl.nn.pytorch.conv.EdgeGATConv(in_feats=in_size*heads, 
+        self.layer_2 = dgl.nn.pytorch.conv.EdgeGATConv(in_feats=in_size if pool_heads else in_size*heads, 
                                                        edge_feats=feat_size, 
                                                        out_feats=in_size, 
                                                        num_heads=heads, 
@@ -286,7 +470,7 @@ class EGAT(nn.Module):
 
     def forward(self, g, h, edge_feat):
         h = self.layer_1(g, h, edge_feat) 
-        h = h.flatten(1)
+        h = h.mean(1) if self.pool_heads else h.flatten(1)
         h = self.activation(h)
         h = self.layer_2(g, h, edge_feat)
         h = h.mean(1)
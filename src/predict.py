@@ -10,6 +10,7 @@ import numpy as np
 
 from tqdm import tqdm
 from models import LinkSeg, FrameEncoder
+from modules import fuse_for_inference, set_qkv_buffers
 from post_processing import post_process, export_to_jams
 from data_utils import read_beats, clean_tracklist_audio, FileStruct, downsample_frames
 
@@ -41,7 +42,8 @@ def load_model(args) -> LinkSeg:
                 hidden_dim=args.hidden_dim,
                 attention_ndim=args.attention_ndim,
                 attention_nlayers=args.attention_nlayers,
-                attention_nheads=args.attention_nheads)
+                attention_nheads=args.attention_nheads,
+                bf16=args.bf16)
     
     model = LinkSeg(encoder, 
                 nb_ssm_classes=args.nb_ssm_classes, 
@@ -51,7 +53,10 @@ def load_model(args) -> LinkSeg:
                 dropout_gnn=args.dropout_gnn,
                 dropout_cnn=args.dropout_cnn,
                 dropout_egat=args.dropout_egat,
-                max_len=args.max_len)
+                max_len=args.max_len,
+                gnn_topk=args.gnn_topk,
+                egat_pool_heads=args.egat_pool_heads,
+                bf16=args.bf16)
 
     print('Model path =', model_path)
 
@@ -71,6 +76,21 @@ def load_model(args) -> LinkSeg:
     model.load_state_dict(new_state_dict, strict=True) 
     
     model.eval()
+    # fold BatchNorm statistics into the preceding convolutions
+    fuse_for_inference(model)
+    if args.quantize:
+        # int8 dynamic quantization of the transformer linears (attention and feed-forward)
+        model.encoder.transformer = torch.ao.quantization.quantize_dynamic(model.encoder.transformer, {torch.nn.Linear}, dtype=torch.qint8)
+    if args.channels_last:
+        # NHWC convolution weights: the layout propagates from the weights to the activations,
+        # so that cuDNN / oneDNN pick their channels-last kernels
+        model = model.to(memory_format=torch.channels_last)
+    if args.compile:
+        # compiled after loading so that the state dict keys are left untouched
+        model.encoder.transformer = torch.compile(model.encoder.transformer)
+    if not (args.compile or args.quantize or args.bf16):
+        # reuse the qkv projection buffer, bounded by the largest track (max_len beats of n_embedding // 4 tokens)
+        set_qkv_buffers(model, args.max_len * (args.n_embedding // 4))
 
     return model
     
@@ -90,7 +110,14 @@ def predict_from_files(args):
     if gpu >= 0 and not torch.cuda.is_available():
         warnings.warn("You're trying to use the GPU but no GPU has been found. Using CPU instead...")
         gpu = -1
+    if args.quantize and gpu >= 0:
+        warnings.warn("Dynamic int8 quantization is only supported on CPU, running the full-precision model instead...")
+        args.quantize = 0
     device = torch.device(f"cuda:{gpu:d}" if gpu >= 0 else "cpu")
+    if gpu >= 0:
+        # TF32 tensor cores for the FP32 matmuls and convolutions (Ampere and newer)
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     print(device)
 
     # define model
@@ -175,6 +202,8 @@ if __name__ == '__main__':
     parser.add_argument('--dropout_gnn', type=float, default=.1)
     parser.add_argument('--dropout_cnn', type=float, default=.2)
     parser.add_argument('--dropout_egat', type=float, default=.5)
+    parser.add_argument('--gnn_topk', type=int, default=0)
+    parser.add_argument('--egat_pool_heads', type=int, default=0)
 
     # peak-picking parameters
     parser.add_argument('--max_past', type=float, default=8)
@@ -186,6 +215,12 @@ if __name__ == '__main__':
     parser.add_argument('--model_name', type=str)
     parser.add_argument('--gpu', type=int, default=-1)
 
+    # inference optimizations
+    parser.add_argument('--compile', type=int, default=0)
+    parser.add_argument('--bf16', type=int, default=0)
+    parser.add_argument('--channels_last', type=int, default=0)
+    parser.add_argument('--quantize', type=int, default=0)
+
     args = parser.parse_args()
 
     print(args)
@@ -55,6 +55,8 @@ def train(args):
                 dropout_cnn=args.dropout_cnn,
                 dropout_egat=args.dropout_egat,
                 max_len=args.max_len,
+                gnn_topk=args.gnn_topk,
+                egat_pool_heads=args.egat_pool_heads,
     )
 
     print(_network)
@@ -162,6 +164,8 @@ if __name__ == '__main__':
     parser.add_argument('--dropout_gnn', type=float, default=.1)
     parser.add_argument('--dropout_cnn', type=float, default=.2)
     parser.add_argument('--dropout_egat', type=float, default=.5)
+    parser.add_argument('--gnn_topk', type=int, default=0)
+    parser.add_argument('--egat_pool_heads', type=int, default=0)
 
     # paths
     #parser.add_argument('--data_path', type=str, default='./../data/')